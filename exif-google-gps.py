@@ -2,10 +2,13 @@
 
 
 import argparse
+import concurrent.futures
 import json
 import logging
+import mmap
 import os.path
-import pickle
+import sqlite3
+import struct
 import sys
 import time
 from datetime import (
@@ -15,17 +18,220 @@ from datetime import (
 from fractions import Fraction
 
 
+import numpy as np
 import piexif
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 LOG_FMT = '[%(levelname)s] %(message)s'
 
+# Location history files bigger than this are stream-parsed
+STREAM_THRESHOLD = 500 * 1024 * 1024
+
+# Number of files whose headers are read and parsed at once in main()
+HEADER_CHUNK = 256
+
+# Rational form of GPS degrees and minutes, always small integers
+_INT_RAT = tuple((i, 1) for i in range(360))
+
+
+def _find_exif_segment(data):
+    # Returns the APP1 Exif payload from JPEG data or None if it can't be
+    # found, including when data is truncated before the segment ends
+    if data[0:2] != b'\xff\xd8':
+        return None
+
+    head = 2
+    while head + 4 <= len(data):
+        marker = data[head:head+2]
+        if marker[0:1] != b'\xff' or marker == b'\xff\xda':
+            return None
+
+        length = struct.unpack('>H', data[head+2:head+4])[0]
+        if head + 2 + length > len(data):
+            return None
+
+        if (marker == b'\xff\xe1' and
+                data[head+4:head+10] == b'Exif\x00\x00'):
+            return data[head+4:head+2+length]
+
+        head = head + 2 + length
+
+    return None
+
+
+def _read_exif_segment(path):
+    # The file is memory-mapped so only the headers are actually read
+    try:
+        with open(path, 'rb') as fh, \
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _find_exif_segment(mm)
+
+    except ValueError:
+        # Empty files can't be mapped
+        return None
+
+
+def _read_header(path, n_bytes):
+    with open(path, 'rb') as fh:
+        return fh.read(n_bytes)
+
+
+def _read_headers(paths, n_bytes=65536):
+    # Reads the first n_bytes of each file concurrently. File reads release
+    # the GIL so threads are enough to keep many requests in flight
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        headers = executor.map(_read_header, paths, [n_bytes] * len(paths))
+        return dict(zip(paths, headers))
+
+
+class ExifCache():
+    # Persistent cache of the Exif and GPS IFDs of already scanned files.
+    # Entries are keyed by path and invalidated by mtime and size changes.
+    # The cache is best-effort: once it fails it gets disabled for the rest
+    # of the run
+    DEFAULT_PATH = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+        'exif-google-gps', 'exif.db')
+
+    # Bump when the table layout or the stored data format changes, older
+    # caches are discarded
+    SCHEMA_VERSION = 2
+
+    # Entries not used for this long are pruned on close()
+    MAX_AGE = 90 * 24 * 60 * 60
+
+    def __init__(self, path=None):
+        path = path or self.DEFAULT_PATH
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path)
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self._db.execute('DROP TABLE IF EXISTS exif')
+            self._db.execute(
+                'PRAGMA user_version = {v}'.format(v=self.SCHEMA_VERSION))
+
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS exif ('
+            ' path TEXT PRIMARY KEY,'
+            ' mtime INTEGER NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' data BLOB NOT NULL,'
+            ' seen INTEGER NOT NULL)')
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+    def _disable(self, err):
+        msg = "exif cache disabled: {err}"
+        msg = msg.format(err=err)
+        logging.warning(msg)
+
+        try:
+            self._db.close()
+        except sqlite3.Error:
+            pass
+
+        self._db = None
+
+    def get(self, path):
+        if self._db is None:
+            return None
+
+        try:
+            row = self._db.execute(
+                'SELECT data FROM exif '
+                'WHERE path = ? AND mtime = ? AND size = ?',
+                self._key(path)).fetchone()
+        except sqlite3.Error as e:
+            self._disable(e)
+            return None
+        except OSError:
+            # Unreadable file, let the EXIF parser report it
+            return None
+
+        if not row:
+            return None
+
+        try:
+            self._db.execute(
+                'UPDATE exif SET seen = ? WHERE path = ?',
+                (int(time.time()), os.path.abspath(path)))
+        except sqlite3.Error as e:
+            self._disable(e)
+
+        # Data is stored as a plain EXIF block, see set()
+        try:
+            exif = piexif.load(row[0])
+        except (ValueError, struct.error):
+            return None
+
+        return {'Exif': exif['Exif'], 'GPS': exif['GPS']}
+
+    def set(self, path, exif):
+        if self._db is None:
+            return
+
+        try:
+            data = piexif.dump({'Exif': exif['Exif'], 'GPS': exif['GPS']})
+        except ValueError:
+            # Tags piexif can't serialize back, just don't cache the file
+            return
+
+        try:
+            self._db.execute(
+                'INSERT OR REPLACE INTO exif VALUES (?, ?, ?, ?, ?)',
+                self._key(path) + (data, int(time.time())))
+        except sqlite3.Error as e:
+            self._disable(e)
+        except OSError:
+            pass
+
+    def commit(self):
+        # Called often so other runs aren't locked out of the database
+        if self._db is None:
+            return
+
+        try:
+            self._db.commit()
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def prune(self):
+        # Drops entries of renamed, deleted or long untouched files
+        if self._db is None:
+            return
+
+        try:
+            self._db.execute(
+                'DELETE FROM exif WHERE seen < ?',
+                (int(time.time()) - self.MAX_AGE,))
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def close(self):
+        self.prune()
+        self.commit()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
 
 class JpegFile():
-    def __init__(self, path, logger=None):
+    def __init__(self, path, logger=None, header=None, cache=None,
+                 exif=None):
         self.path = path
+        self._header = header
+        self._cache = cache
         self._ts = None
-        self._exif = None
+        self._exif = exif
 
     @property
     def timestamp(self):
@@ -36,11 +242,27 @@ class JpegFile():
 
     @property
     def exif(self):
+        # When a cache is used this may only hold the Exif and GPS IFDs
+        if self._exif is None and self._cache is not None:
+            self._exif = self._cache.get(self.path)
+
         if self._exif is None:
-            self._exif = piexif.load(self.path)
+            self._exif = self._load_exif()
+            if self._cache is not None:
+                self._cache.set(self.path, self._exif)
 
         return self._exif
 
+    def _load_exif(self):
+        data = None
+        if self._header is not None:
+            data = _find_exif_segment(self._header)
+        if data is None:
+            data = _read_exif_segment(self.path)
+
+        self._header = None
+        return piexif.load(data or self.path)
+
     @property
     def has_geo(self):
         try:
@@ -59,17 +281,13 @@ class JpegFile():
             Keyword arguments: value is float gps-value, loc is direction list["S", "N"] or ["W", "E"]
             return: tuple like (25, 13, 48.343 ,'N')
             """
-            if value < 0:
-                loc_value = loc[0]
-            elif value > 0:
-                loc_value = loc[1]
-            else:
-                loc_value = ""
-            abs_value = abs(value)
-            deg = int(abs_value)
-            t1 = (abs_value - deg) * 60
-            min = int(t1)
-            sec = round((t1 - min) * 60, 5)
+            loc_value = loc[int(value > 0)] if value else ""
+            # Work in integer micro arc-seconds so rounding can't produce
+            # 60 seconds or 60 minutes
+            micro = int(round(abs(value) * 3600000000))
+            deg, rem = divmod(micro, 3600000000)
+            min, rem = divmod(rem, 60000000)
+            sec = rem / 1000000
             return (deg, min, sec, loc_value)
 
         def change_to_rational(number):
@@ -77,22 +295,22 @@ class JpegFile():
             Keyword arguments: number
             return: tuple like (1, 2), (numerator, denominator)
             """
-            f = Fraction(str(number))
+            f = Fraction(number).limit_denominator(100000)
             return (f.numerator, f.denominator)
 
         lat_deg = to_deg(lat, ["S", "N"])
         lng_deg = to_deg(lng, ["W", "E"])
 
         exiv_lat = (
-            change_to_rational(lat_deg[0]),
-            change_to_rational(lat_deg[1]),
+            _INT_RAT[lat_deg[0]],
+            _INT_RAT[lat_deg[1]],
             change_to_rational(lat_deg[2]))
         exiv_lng = (
-            change_to_rational(lng_deg[0]),
-            change_to_rational(lng_deg[1]),
+            _INT_RAT[lng_deg[0]],
+            _INT_RAT[lng_deg[1]],
             change_to_rational(lng_deg[2]))
 
-        self.exif['GPS'] = {
+        gps_ifd = {
             piexif.GPSIFD.GPSVersionID: (2, 0, 0, 0),
             # piexif.GPSIFD.GPSAltitudeRef: 1,
             # piexif.GPSIFD.GPSAltitude: change_to_rational(round(altitude)),
@@ -102,7 +320,20 @@ class JpegFile():
             piexif.GPSIFD.GPSLongitude: exiv_lng,
         }
 
-        piexif.insert(piexif.dump(self.exif), self.path)
+        exif = self.exif
+        if '0th' not in exif:
+            # Cached EXIF, the full set of tags is needed to write
+            exif = self._load_exif()
+
+        # piexif.insert() replaces the whole APP1 segment, existing tags
+        # must be carried over unless there are none
+        if any(v for (k, v) in exif.items() if k != 'GPS'):
+            exif = dict(exif, GPS=gps_ifd)
+        else:
+            exif = {'GPS': gps_ifd}
+
+        piexif.insert(piexif.dump(exif), self.path)
+        self._exif = exif
 
     def _get_timestmap(self):
         # Code ripped from ocdutils: http://github.com/ldotlopez/ocdutils
@@ -120,13 +351,17 @@ class JpegFile():
                 t[key] = None
                 continue
 
+            # Fixed 'YYYY:MM:DD HH:MM:SS' layout, slicing is much faster
+            # than strptime
             delta = timedelta()
+            hour = int(dt[11:13])
 
-            if dt.find(' 24:') > 0:
-                dt = dt.replace(' 24:', ' 00:')
-                delta = datetime.timedelta(days=1)
+            if hour == 24:
+                hour = 0
+                delta = timedelta(days=1)
 
-            dt = datetime.strptime(dt, '%Y:%m:%d %H:%M:%S')
+            dt = datetime(int(dt[0:4]), int(dt[5:7]), int(dt[8:10]),
+                          hour, int(dt[14:16]), int(dt[17:19]))
             dt = dt + delta
 
             t[key] = dt
@@ -141,7 +376,7 @@ class JpegFile():
             raise ValueError(msg)
 
         dt = t['digitized'] or t['original']
-        return int(time.mktime(dt.timetuple()))
+        return int(dt.timestamp())
 
     def __unicode__(self):
         return self.path
@@ -151,62 +386,134 @@ class JpegFile():
 
 
 class GeoData():
+    CACHE_COLUMNS = ('ts', 'lat', 'lng')
+
     def __init__(self, locations_json=None):
         name, _ = os.path.splitext(locations_json)
-        dump_file = name + '.bin'
 
-        try:
-            with open(dump_file, 'rb') as fh:
-                self._d = pickle.load(fh)
+        # Raw timestamp, latitude and longitude columns, see compile()
+        self._d = ([], [], [])
+        self._ts = self._lat = self._lng = None
 
-        except IOError:
-            self._d = set()
+        try:
+            # Each column lives in its own .npy file so it can be
+            # memory-mapped, np.load ignores mmap_mode for .npz archives
+            self._ts, self._lat, self._lng = (
+                np.load(name + '.' + col + '.npy', mmap_mode='r')
+                for col in self.CACHE_COLUMNS)
+
+        except (IOError, ValueError):
+            for location in self._read_locations(locations_json):
+                self.save(location)
+
+            self.dump(name)
+
+    @staticmethod
+    def _read_locations(locations_json):
+        # Parsing the whole file at once is faster but needs memory
+        # proportional to its size, huge files are streamed instead
+        if os.path.getsize(locations_json) > STREAM_THRESHOLD:
+            try:
+                import ijson
+            except ImportError:
+                msg = ("ijson not available, loading the whole location "
+                       "history in memory")
+                logging.warning(msg)
+            else:
+                with open(locations_json, 'rb') as fh:
+                    yield from ijson.items(fh, 'locations.item',
+                                           use_float=True)
+                return
 
-            with open(locations_json, 'r', encoding='utf-8') as fh:
-                for location in json.load(fh)['locations']:
-                    self.save(location)
+        with open(locations_json, 'rb') as fh:
+            data = fh.read()
 
-            with open(dump_file, 'wb+') as fh:
-                fh.write(self.dump())
+        if orjson is not None:
+            yield from orjson.loads(data)['locations']
+        else:
+            yield from json.loads(data)['locations']
 
     def save(self, location):
-        self._d.add(
-            (int(location['timestampMs']) / 1000,
-             location['latitudeE7'] / 10000000,
-             location['longitudeE7'] / 10000000)
-        )
+        ts, lat, lng = self._d
+        ts.append(int(location['timestampMs']) // 1000)
+        lat.append(location['latitudeE7'] / 10000000)
+        lng.append(location['longitudeE7'] / 10000000)
 
     def search(self, ts, max_delta):
-        def check_bounds(ts_):
-            return True
+        lats, lngs, valid = self.search_batch([ts], max_delta)
+        if not valid[0]:
+            if ts < self._ts[0] or ts > self._ts[-1]:
+                raise ValueError(ts)
 
-        if len(self._d) < 2:
-            raise ValueError('No data available')
+            raise ValueError('Max delta')
 
-        for idx in range(0, len(self._d) - 1):
-            delta_prev = self._d[idx][0] - ts
-            delta_post = self._d[idx+1][0] - ts
+        return float(lats[0]), float(lngs[0])
 
-            if not (delta_prev <= 0 and delta_post >= 0):
-                continue
+    def search_batch(self, ts, max_delta):
+        self.compile()
 
-            if delta_prev > max_delta and delta_post > max_delta:
-                raise ValueError('Max delta')
+        if len(self._ts) < 2:
+            raise ValueError('No data available')
 
-            if abs(delta_prev) < abs(delta_post):
-                return self._d[idx][1], self._d[idx][2]
-            else:
-                return self._d[idx+1][1], self._d[idx+1][2]
+        ts = np.asarray(ts, dtype=np.int64)
 
-        raise ValueError(ts)
+        idx = np.clip(np.searchsorted(self._ts, ts), 1, len(self._ts) - 1)
+        delta_prev = np.abs(self._ts[idx-1] - ts)
+        delta_post = np.abs(self._ts[idx] - ts)
+        idx = np.where(delta_prev < delta_post, idx - 1, idx)
 
-    def compile(self):
-        if not isinstance(self._d, list):
-            self._d = sorted(self._d)
+        # Timestamps must be between two known locations and close enough
+        # to one of them
+        valid = (
+            (ts >= self._ts[0]) &
+            (ts <= self._ts[-1]) &
+            (np.minimum(delta_prev, delta_post) <= max_delta))
 
-    def dump(self):
+        return self._lat[idx], self._lng[idx], valid
+
+    def compile(self):
+        ts, lat, lng = self._d
+        if self._ts is not None and not ts:
+            return
+
+        ts = np.asarray(ts, dtype=np.int64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+
+        # Locations saved after a previous compile() are merged in
+        if self._ts is not None:
+            ts = np.concatenate((self._ts, ts))
+            lat = np.concatenate((self._lat, lat))
+            lng = np.concatenate((self._lng, lng))
+
+        # Raw columns aren't needed anymore, don't keep them around next to
+        # the arrays
+        self._d = ([], [], [])
+
+        # np.unique() sorts and drops duplicated timestamps, keeping the
+        # first location seen for each one
+        self._ts, uniq = np.unique(ts, return_index=True)
+        self._lat = lat[uniq]
+        self._lng = lng[uniq]
+
+    def dump(self, name):
         self.compile()
-        return pickle.dumps(self._d)
+
+        columns = (self._ts, self._lat, self._lng)
+        for (col, arr) in zip(self.CACHE_COLUMNS, columns):
+            np.save(name + '.' + col + '.npy', arr)
+
+
+def _process_one(job):
+    # Runs in a worker process, only resolved coordinates are sent over
+    path, lat, lng = job
+
+    jpg = JpegFile(path)
+    if jpg.has_geo:
+        return False
+
+    jpg.write_lat_lng(lat, lng)
+    return True
 
 
 def main():
@@ -232,6 +539,7 @@ def main():
         default='0')
     parser.add_argument(
         '--max-delta',
+        type=int,
         default=60*15,  # 15 minutes
         help=("Max desviation between JPG exif datetime and data from "
               "location history file"))
@@ -239,6 +547,11 @@ def main():
         '-n', '--dry_run',
         action='store_true',
         help="Don't write GPS data, just print what would be done")
+    parser.add_argument(
+        '--no-exif-cache',
+        action='store_true',
+        help=("Don't use the cache of already scanned files "
+              "({path})".format(path=ExifCache.DEFAULT_PATH)))
     parser.add_argument(
         '-v', '--verbose',
         action='store_true',
@@ -258,29 +571,83 @@ def main():
 
     geo = GeoData(args.geo)
 
-    for jpg in args.files:
-        jpg = JpegFile(jpg)
-
-        lat, lng = geo.search(jpg.timestamp + args.offset,
-                              max_delta=args.max_delta)
+    cache = None
+    if not args.no_exif_cache:
+        try:
+            cache = ExifCache()
+        except (OSError, sqlite3.Error) as e:
+            msg = "exif cache disabled: {err}"
+            msg = msg.format(err=e)
+            logging.warning(msg)
+
+    # Files are scanned in chunks so only a bounded number of pre-read
+    # headers is kept in memory. Already tagged files are discarded before
+    # any timestamp parsing or location search is done
+    entries = []
+    try:
+        for idx in range(0, len(args.files), HEADER_CHUNK):
+            chunk = args.files[idx:idx + HEADER_CHUNK]
+
+            cached = {}
+            if cache is not None:
+                cached = {f: cache.get(f) for f in chunk}
+
+            # Cached files don't need their headers read
+            headers = _read_headers(
+                [f for f in chunk if cached.get(f) is None])
+
+            for jpg in chunk:
+                jpg = JpegFile(jpg, header=headers.pop(jpg, None),
+                               cache=cache, exif=cached.get(jpg))
+                if not args.dry_run and jpg.has_geo:
+                    msg = ("skipping: '{jpg}' already has GPS data. "
+                           "try --force")
+                    msg = msg.format(jpg=jpg.path)
+                    logging.info(msg)
+                    continue
+
+                entries.append((jpg.path, jpg.timestamp + args.offset))
+
+            if cache is not None:
+                cache.commit()
+
+    finally:
+        # Keep what was scanned even if some file failed
+        if cache is not None:
+            cache.close()
+
+    lats, lngs, valid = geo.search_batch(
+        [ts for (_, ts) in entries],
+        max_delta=args.max_delta)
+
+    jobs = []
+    for ((path, ts), lat, lng, found) in zip(entries, lats, lngs, valid):
+        if not found:
+            msg = "skipping: no location data found for '{jpg}'"
+            msg = msg.format(jpg=path)
+            logging.warning(msg)
+            continue
 
         if args.dry_run or args.verbose:
             msg = ('[{f}] {dt} ({lat}, {lng}) '
                    'https://www.google.com/maps?z=14&q=loc:{lat},{lng}')
             msg = msg.format(
-                dt=datetime.strftime(
-                    datetime.fromtimestamp(jpg.timestamp + args.offset), '%c'),
-                f=jpg, ts=jpg.timestamp, lat=lat, lng=lng)
+                dt=datetime.strftime(datetime.fromtimestamp(ts), '%c'),
+                f=path, ts=ts, lat=lat, lng=lng)
             logging.info(msg)
 
-        if not args.dry_run:
-            if jpg.has_geo:
+        jobs.append((path, float(lat), float(lng)))
+
+    if args.dry_run:
+        return
+
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(_process_one, jobs, chunksize=32)
+        for ((path, _, _), written) in zip(jobs, results):
+            if not written:
                 msg = "skipping: '{jpg}' already has GPS data. try --force"
-                msg = msg.format(jpg=str(jpg))
+                msg = msg.format(jpg=path)
                 logging.info(msg)
-                continue
-
-            jpg.write_lat_lng(lat, lng)
 
 
 if __name__ == '__main__':